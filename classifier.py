@@ -1,19 +1,34 @@
 #!/usr/bin/env python3
 import os
+import sys
 import re
 import json
 import time
+import asyncio
+import sqlite3
+import hashlib
 import argparse
+import collections
+import functools
 import yaml
-import openai
 import subprocess
-from ollama import Client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import parse_qs
+from openai import AsyncOpenAI
+from ollama import AsyncClient
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # OpenAI Settings
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-api-key")
 if OPENAI_API_KEY == "your-openai-api-key":
     raise ValueError("Please set your OpenAI API key in the OPENAI_API_KEY environment variable or directly in the script.")
-openai.api_key = OPENAI_API_KEY
+# The client retries 429s and transient errors itself, honouring the
+# Retry-After headers; RateLimiter keeps us from hitting them in the first place.
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=5)
 
 CUSTOM_PROMPT = (
     "The following documentation content is provided from a MkDocs file. "
@@ -31,7 +46,32 @@ CUSTOM_PROMPT = (
     "Ensure your response is a valid JSON object."
 )
 
-class CustomLoader(yaml.SafeLoader):
+PACKED_PROMPT = (
+    "The following documentation content is provided from several MkDocs files, each starting with a "
+    "'=== DOC <id>: <file> ===' header. "
+    "Please analyze each document separately and classify it into the Diátaxis documentation framework quadrants:\n"
+    "    - Explanation\n"
+    "    - Tutorial\n"
+    "    - How-To\n"
+    "    - Reference\n\n"
+    "For each document and each quadrant, provide a percentage fit as an integer between 0 and 100 (without the '%' sign) "
+    "that indicates how much the content aligns with that quadrant. Also, indicate the most dominant quadrant. "
+    "Return the output as a JSON object with a single key 'results' holding an array with one entry per document, "
+    "each with keys 'id' (the integer document id), 'dominant', 'explanation', 'tutorial', 'how_to', and 'reference'."
+    "In the returned output in JSON, ensure the values of 'dominant' is only one of the following, case-sensitive values: 'explanation', 'tutorial', 'how_to', and 'reference'.\n\n"
+    "Here is the documentation content:\n\n"
+    "{documents}\n\n"
+    "Ensure your response is a valid JSON object."
+)
+
+# Split the templates once so building a prompt is a plain concatenation.
+PROMPT_PREFIX, _, PROMPT_SUFFIX = CUSTOM_PROMPT.partition("{content}")
+PACKED_PROMPT_PREFIX, _, PACKED_PROMPT_SUFFIX = PACKED_PROMPT.partition("{documents}")
+
+_REASONING_MODEL_RE = re.compile(r"o\d")
+
+# Prefer the libyaml-backed loader when PyYAML was built with it.
+class CustomLoader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
     pass
 
 def ignore_unknown(loader, tag_suffix, node):
@@ -47,19 +87,46 @@ def ignore_unknown(loader, tag_suffix, node):
 CustomLoader.add_multi_constructor("tag:yaml.org,2002:python/name:", ignore_unknown)
 CustomLoader.add_multi_constructor("!", ignore_unknown)
 
-# multi-repo plugin support
-def clone_multi_repos(mkdocs_config_path, target_dir):
+def load_config(mkdocs_config_path):
     """
-    Parse the mkdocs.yml file for the multi-repo plugin configuration,
-    then clone (or update) each repository from the 'nav_repos' section.
-    Repositories are cloned into target_dir/<repo_name>.
+    Parse the MkDocs configuration file, ignoring any unknown YAML tags.
     """
     if not os.path.exists(mkdocs_config_path):
         raise FileNotFoundError(f"Could not find {mkdocs_config_path}")
-    
     with open(mkdocs_config_path, "r", encoding="utf-8") as f:
-        config = yaml.load(f, Loader=CustomLoader)
-    
+        return yaml.load(f, Loader=CustomLoader)
+
+# multi-repo plugin support
+def sync_repo(name, import_url, destination):
+    """
+    Shallow-clone a single repository into destination, or update it to
+    the latest commit if it is already there. Only the current tree is
+    needed, so history is never fetched. Raises
+    subprocess.CalledProcessError on failure.
+    """
+    base_url, _, query = import_url.partition("?")
+    branch = parse_qs(query).get("branch", [None])[0]
+    if os.path.exists(destination):
+        print(f"Repository '{name}' already exists. Updating...")
+        # 'git pull' would deepen the shallow clone; fetch just the tip and reset to it.
+        subprocess.run(
+            ["git", "-C", destination, "fetch", "--depth", "1", "origin", branch or "HEAD"],
+            check=True, capture_output=True,
+        )
+        subprocess.run(["git", "-C", destination, "reset", "--hard", "FETCH_HEAD"], check=True, capture_output=True)
+    else:
+        print(f"Cloning repository '{name}' from {base_url} ...")
+        cmd = ["git", "clone", "--depth", "1", "--filter=blob:none", "--single-branch"]
+        if branch:
+            cmd += ["--branch", branch]
+        subprocess.run(cmd + [base_url, destination], check=True, capture_output=True)
+
+def clone_multi_repos(config, target_dir):
+    """
+    Look up the multi-repo plugin configuration in the parsed mkdocs.yml,
+    then clone (or update) each repository from the 'nav_repos' section.
+    Repositories are cloned into target_dir/<repo_name>.
+    """
     plugins = config.get("plugins", [])
     multi_repo_config = None
     for item in plugins:
@@ -77,147 +144,579 @@ def clone_multi_repos(mkdocs_config_path, target_dir):
         return
 
     os.makedirs(target_dir, exist_ok=True)
-    for repo in nav_repos:
-        name = repo.get("name")
-        import_url = repo.get("import_url")
-        if not name or not import_url:
-            print(f"Skipping invalid repo entry: {repo}")
-            continue
-        destination = os.path.join(target_dir, name)
-        if os.path.exists(destination):
-            print(f"Repository '{name}' already exists. Updating...")
-            try:
-                subprocess.run(["git", "-C", destination, "pull"], check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Error updating {name}: {e}")
-        else:
-            base_url = import_url.split("?")[0]
-            print(f"Cloning repository '{name}' from {base_url} ...")
+    # Git is network-bound, so clone/update all repositories in parallel.
+    with ThreadPoolExecutor(max_workers=min(16, len(nav_repos))) as executor:
+        futures = {}
+        for repo in nav_repos:
+            name = repo.get("name")
+            import_url = repo.get("import_url")
+            if not name or not import_url:
+                print(f"Skipping invalid repo entry: {repo}")
+                continue
+            destination = os.path.join(target_dir, name)
+            futures[executor.submit(sync_repo, name, import_url, destination)] = name
+        for future in as_completed(futures):
+            name = futures[future]
             try:
-                subprocess.run(["git", "clone", base_url, destination], check=True)
+                future.result()
             except subprocess.CalledProcessError as e:
-                print(f"Error cloning {name}: {e}")
+                stderr = e.stderr.decode("utf-8", "replace").strip() if e.stderr else ""
+                print(f"Error cloning/updating {name}: {e}" + (f"\n{stderr}" if stderr else ""))
 
-def load_mkdocs_nav(mkdocs_config_path):
+def load_mkdocs_nav(config):
     """
     Load the file paths specified in the 'nav' section of the MkDocs configuration.
     Ignores any URLs.
     """
-    if not os.path.exists(mkdocs_config_path):
-        raise FileNotFoundError(f"Could not find {mkdocs_config_path}")
-    with open(mkdocs_config_path, "r", encoding="utf-8") as f:
-        config = yaml.load(f, Loader=CustomLoader)
     nav_files = []
-    nav = config.get("nav", [])
-    
-    def extract_files(item):
+    # Walk the nav tree with an explicit stack. Children are pushed in
+    # reverse so files come out in nav order.
+    stack = collections.deque([config.get("nav", [])])
+    while stack:
+        item = stack.pop()
         if isinstance(item, dict):
-            for key, value in item.items():
-                if isinstance(value, list):
-                    for v in value:
-                        extract_files(v)
-                elif isinstance(value, str):
-                    if value.startswith("http://") or value.startswith("https://"):
-                        return
-                    nav_files.append(re.split(r"#", value)[0])
+            stack.extend(reversed(item.values()))
         elif isinstance(item, list):
-            for v in item:
-                extract_files(v)
-    
-    extract_files(nav)
+            stack.extend(reversed(item))
+        elif isinstance(item, str) and not item.startswith(("http://", "https://")):
+            nav_files.append(item.partition("#")[0])
     return nav_files
 
-def read_file_content(file_path, config_path, clone_dir):
+def find_file(file_path, roots):
     """
-    Deduces the docs directory from the MkDocs config file.
-    If 'docs_dir' is not specified in the config, defaults to 'docs'.
-    Searches for the file in:
-      1. base_dir/docs_dir/
-      2. base_dir/
+    Searches for the file in each of the candidate roots in order, which
+    main() sets up as:
+      1. base/docs_dir/
+      2. base/
       3. The cloned repositories in clone_dir
     """
-    with open(config_path, "r", encoding="utf-8") as f:
-        config = yaml.load(f, Loader=CustomLoader)
-    docs_dir = config.get("docs_dir", "docs")
-    base = os.path.dirname(config_path)
-    
-    candidate = os.path.join(base, docs_dir, file_path)
-    if os.path.exists(candidate):
-        with open(candidate, "r", encoding="utf-8") as f:
-            return f.read()
-    candidate = os.path.join(base, file_path)
-    if os.path.exists(candidate):
-        with open(candidate, "r", encoding="utf-8") as f:
-            return f.read()
-    candidate = os.path.join(clone_dir, file_path)
-    if os.path.exists(candidate):
-        with open(candidate, "r", encoding="utf-8") as f:
-            return f.read()
+    for root in roots:
+        candidate = os.path.join(root, file_path)
+        if os.path.isfile(candidate):
+            return candidate
     raise FileNotFoundError(f"File '{file_path}' not found in expected locations.")
 
-def truncate_content(content, max_chars):
-    return content[:max_chars] if len(content) > max_chars else content
+def read_file_content(file_path, roots, max_chars):
+    """
+    Returns at most max_chars characters of the file's content.
+    """
+    # A UTF-8 character is at most 4 bytes, so there is no need to read
+    # (or decode) more than that from large files.
+    with open(find_file(file_path, roots), "rb") as f:
+        data = f.read(max_chars * 4)
+    return data.decode("utf-8", "ignore")[:max_chars]
 
-def send_to_openai(prompt, model):
-    retries = 0
-    retry_delay = 2
-    max_retries = 5
-    while retries < max_retries:
-        try:
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=[
-                    {"role": "user", "content": prompt},
-                ],
-            )
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            error_str = str(e)
-            if "Rate limit reached" in error_str:
-                m = re.search(r"Please try again in ([\d.]+)s", error_str)
-                wait_time = float(m.group(1)) if m else retry_delay
-                print(f"Rate limit encountered (OpenAI), sleeping for {wait_time} seconds...")
-                time.sleep(wait_time)
-                retries += 1
-            else:
-                print(f"Error contacting OpenAI API: {e}")
-                return None
-    print("Max retries reached for OpenAI; moving on.")
-    return None
+async def read_files(files, roots, max_chars):
+    """
+    Read several files concurrently in worker threads. Returns the content
+    of each file in order, or the exception raised while reading it.
+    """
+    return await asyncio.gather(
+        *(asyncio.to_thread(read_file_content, file, roots, max_chars) for file in files),
+        return_exceptions=True,
+    )
+
+class RateLimiter:
+    """
+    Request and token buckets sized to the OpenAI per-minute limits. Both
+    buckets refill continuously with the time elapsed since the last check;
+    acquire() waits exactly as long as needed for the next request to fit.
+    """
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_request_capacity = min(
+            self.max_requests_per_minute,
+            self.available_request_capacity + self.max_requests_per_minute / 60 * elapsed,
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + self.max_tokens_per_minute / 60 * elapsed,
+        )
+
+    async def acquire(self, tokens):
+        # A single request larger than the whole bucket would otherwise wait forever.
+        tokens = min(tokens, self.max_tokens_per_minute)
+        while True:
+            self._refill()
+            request_shortfall = 1 - self.available_request_capacity
+            token_shortfall = tokens - self.available_token_capacity
+            if request_shortfall <= 0 and token_shortfall <= 0:
+                break
+            await asyncio.sleep(max(
+                request_shortfall / (self.max_requests_per_minute / 60),
+                token_shortfall / (self.max_tokens_per_minute / 60),
+            ))
+        self.available_request_capacity -= 1
+        self.available_token_capacity -= tokens
+
+def count_tokens(text, model):
+    """
+    Count tokens with tiktoken when it is installed and knows the model,
+    otherwise estimate ~4 characters per token.
+    """
+    if tiktoken is None:
+        return len(text) // 4
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+def pack_documents(docs, model, max_tokens):
+    """
+    Group (file, content) pairs so that the combined content of each group
+    stays under max_tokens. A document larger than max_tokens gets a group
+    of its own.
+    """
+    groups = []
+    group = []
+    group_tokens = 0
+    for file, content in docs:
+        tokens = count_tokens(content, model)
+        if group and group_tokens + tokens > max_tokens:
+            groups.append(group)
+            group = []
+            group_tokens = 0
+        group.append((file, content))
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+class ResponseCache:
+    """
+    On-disk cache of raw model responses, keyed by a hash of the provider,
+    model and prompt, so re-runs skip files whose prompt has not changed.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS c(key TEXT PRIMARY KEY, value TEXT)")
+
+    @staticmethod
+    def key(provider, model, prompt):
+        return hashlib.sha256(f"{provider}|{model}|{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT value FROM c WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO c(key, value) VALUES (?, ?)", (key, value))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError as e:
+        print(f"Ignoring unreadable manifest {path}: {e}")
+        return {}
+
+def save_manifest(path, manifest):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+
+def manifest_key(file_path, roots, args):
+    """
+    Identify the state of a file for incremental runs: its mtime and size,
+    plus the settings and prompt template that affect its classification.
+    Returns None if the file cannot be found.
+    """
+    try:
+        st = os.stat(find_file(file_path, roots))
+    except OSError:
+        return None
+    # --batch always sends one file per request, so --pack has no effect there.
+    packed = args.pack and not (args.batch and args.provider == "openai")
+    template = PACKED_PROMPT if packed else CUSTOM_PROMPT
+    prompt_hash = hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+    return [st.st_mtime_ns, st.st_size, args.provider, args.model, args.max_chars, packed, prompt_hash]
+
+def openai_chat_params(prompt, model):
+    """
+    Chat completion parameters shared by direct requests and Batch API lines.
+    temperature=0 keeps responses deterministic, which is what makes them
+    safe to cache, and JSON mode guarantees the response is a JSON object.
+    Reasoning models (o1, o3, ...) support neither, so they get the defaults.
+    """
+    params = {
+        "model": model,
+        "messages": [
+            {"role": "user", "content": prompt},
+        ],
+    }
+    if not _REASONING_MODEL_RE.match(model):
+        params["temperature"] = 0
+        params["response_format"] = {"type": "json_object"}
+    return params
 
-def send_to_ollama(prompt, model, ollama_host):
+async def send_to_openai(prompt, model, limiter):
+    await limiter.acquire(count_tokens(prompt, model))
     try:
-        client = Client(host=ollama_host)
-        response = client.chat(
+        response = await openai_client.chat.completions.create(**openai_chat_params(prompt, model))
+        return response.choices[0].message.content
+    except Exception as e:
+        print(f"Error contacting OpenAI API: {e}")
+        return None
+
+@functools.lru_cache(maxsize=4)
+def _ollama_client(host):
+    # Reuse one client (and its HTTP connection pool) per host.
+    return AsyncClient(host=host)
+
+async def send_to_ollama(prompt, model, ollama_host):
+    """
+    Concurrent requests only run in parallel if the Ollama server allows it;
+    see OLLAMA_NUM_PARALLEL in the server's environment.
+    """
+    try:
+        client = _ollama_client(ollama_host)
+        response = await client.chat(
             model=model,
             messages=[
                 {"role": "system", "content": "You are an expert documentation analyst."},
                 {"role": "user", "content": prompt},
             ],
-            stream=False
+            stream=False,
+            format="json",
+            options={"temperature": 0},
         )
         return response.message.content
     except Exception as e:
         print(f"Error contacting Ollama API: {e}")
         return None
 
-def send_request(prompt, provider, model, ollama_host):
+def is_valid_response(response_text):
+    parsed = parse_json_response(response_text)
+    return isinstance(parsed, dict) and "error" not in parsed
+
+async def send_request(prompt, provider, model, ollama_host, limiter, cache):
+    if cache is not None:
+        key = ResponseCache.key(provider, model, prompt)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
     if provider.lower() == "ollama":
-        return send_to_ollama(prompt, model, ollama_host)
+        response = await send_to_ollama(prompt, model, ollama_host)
     else:
-        return send_to_openai(prompt, model)
+        response = await send_to_openai(prompt, model, limiter)
+    # Only cache responses that parse; a truncated or prose reply would
+    # otherwise be replayed on every re-run of the same prompt.
+    if cache is not None and response and is_valid_response(response):
+        cache.set(key, response)
+    return response
+
+async def send_batch_request(docs, provider, model, ollama_host, limiter, cache):
+    """
+    Classify several (file, content) pairs with a single request and
+    return a dict mapping each file to its parsed result.
+    """
+    documents = "\n\n".join(
+        f"=== DOC {i}: {file} ===\n{content}" for i, (file, content) in enumerate(docs, 1)
+    )
+    prompt = PACKED_PROMPT_PREFIX + documents + PACKED_PROMPT_SUFFIX
+    raw_response = await send_request(prompt, provider, model, ollama_host, limiter, cache)
+    if not raw_response:
+        return {file: None for file, _ in docs}
+    parsed = parse_json_response(raw_response)
+    if "error" in parsed:
+        return {file: parsed for file, _ in docs}
+
+    by_id = {}
+    for item in parsed.get("results", []):
+        if isinstance(item, dict) and "id" in item:
+            by_id[str(item.pop("id"))] = item
+    results = {}
+    for i, (file, _) in enumerate(docs, 1):
+        results[file] = by_id.get(
+            str(i), {"error": f"No result returned for document {i}", "raw_response": raw_response}
+        )
+    return results
 
 def parse_json_response(response_text):
+    try:
+        return json.loads(response_text)
+    except (TypeError, ValueError):
+        pass
+    # Models without JSON mode (e.g. o1) may wrap the object in prose or code fences.
     try:
         start = response_text.find('{')
-        end = response_text.rfind('}') + 1
-        if start == -1 or end == -1:
+        if start == -1:
             raise ValueError("No valid JSON object found.")
-        json_text = response_text[start:end]
-        return json.loads(json_text)
+        return json.JSONDecoder().raw_decode(response_text, start)[0]
     except Exception as e:
         return {"error": f"Error parsing JSON: {e}", "raw_response": response_text}
 
+class ResultRecorder:
+    """
+    Receives each file's result as soon as it is available: appends a JSON
+    line to the --out file, if any, and records successful results in the
+    manifest so that an interrupted run still counts for the next one.
+    """
+    def __init__(self, out, manifest, keys):
+        self.out = out
+        self.manifest = manifest
+        self.keys = keys
+
+    def record(self, file, result):
+        if self.out is not None:
+            self.out.write(json.dumps({"file": file, "result": result}) + "\n")
+            self.out.flush()
+        key = self.keys.get(file)
+        if self.manifest is not None and key is not None and isinstance(result, dict) and "error" not in result:
+            self.manifest[file] = {"key": key, "result": result}
+
+async def process_file(file, args, roots, read_ahead, semaphore, limiter, cache):
+    try:
+        # read_ahead bounds how many files are read (and held in memory)
+        # ahead of the requests in flight.
+        async with read_ahead:
+            # Read in a worker thread so disk I/O overlaps with requests in flight.
+            content = await asyncio.to_thread(read_file_content, file, roots, args.max_chars)
+            prompt = PROMPT_PREFIX + content + PROMPT_SUFFIX
+            async with semaphore:
+                print(f"\nProcessing file: {file}")
+                raw_response = await send_request(prompt, args.provider, args.model, args.ollama_host, limiter, cache)
+        if raw_response:
+            parsed = parse_json_response(raw_response)
+            print(f"\nResponse for {file}:\n{json.dumps(parsed, indent=4)}")
+            return parsed
+        print(f"No response received for file {file}.")
+        return None
+    except Exception as e:
+        err_msg = f"Error processing file {file}: {e}"
+        print(err_msg)
+        return err_msg
+
+async def process_group(docs, args, semaphore, limiter, cache, recorder):
+    files = [file for file, _ in docs]
+    try:
+        async with semaphore:
+            print(f"\nProcessing {len(files)} file(s): {', '.join(files)}")
+            results = await send_batch_request(docs, args.provider, args.model, args.ollama_host, limiter, cache)
+        for file, parsed in results.items():
+            print(f"\nResponse for {file}:\n{json.dumps(parsed, indent=4)}")
+    except Exception as e:
+        err_msg = f"Error processing files {', '.join(files)}: {e}"
+        print(err_msg)
+        results = {file: err_msg for file in files}
+    for file, parsed in results.items():
+        recorder.record(file, parsed)
+    return results
+
+async def process_files_packed(nav_files, args, roots, semaphore, limiter, cache, recorder):
+    """
+    Read every nav file, pack them into groups of up to args.pack_max_tokens
+    tokens and classify each group with a single request.
+    """
+    results = {}
+    docs = []
+    files = list(dict.fromkeys(nav_files))
+    for file, content in zip(files, await read_files(files, roots, args.max_chars)):
+        if isinstance(content, Exception):
+            err_msg = f"Error processing file {file}: {content}"
+            print(err_msg)
+            results[file] = err_msg
+            recorder.record(file, err_msg)
+        else:
+            docs.append((file, content))
+    groups = pack_documents(docs, args.model, args.pack_max_tokens)
+    print(f"Packed {len(docs)} file(s) into {len(groups)} request(s).")
+    for group_results in await asyncio.gather(*(
+        process_group(group, args, semaphore, limiter, cache, recorder) for group in groups
+    )):
+        results.update(group_results)
+    return {file: results.get(file) for file in nav_files}
+
+async def process_files(nav_files, args, roots, cache, recorder):
+    """
+    Classify all nav files concurrently, with at most --concurrency
+    requests in flight and OpenAI requests throttled to the configured
+    per-minute request and token limits. Each result is passed to recorder as
+    soon as it is available.
+    """
+    concurrency = args.concurrency
+    if concurrency is None:
+        # A local Ollama server typically handles only a few requests in parallel.
+        concurrency = 4 if args.provider == "ollama" else 10
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(args.max_requests_per_minute, args.max_tokens_per_minute)
+    if args.pack:
+        return await process_files_packed(nav_files, args, roots, semaphore, limiter, cache, recorder)
+
+    # Allow up to 8 files to be read ahead of the requests in flight.
+    read_ahead = asyncio.Semaphore(concurrency + 8)
+
+    async def classify(file):
+        parsed = await process_file(file, args, roots, read_ahead, semaphore, limiter, cache)
+        recorder.record(file, parsed)
+        return parsed
+
+    # A page listed twice in the nav is only classified once.
+    files = list(dict.fromkeys(nav_files))
+    results = dict(zip(files, await asyncio.gather(*(classify(file) for file in files))))
+    return {file: results[file] for file in nav_files}
+
+async def process_files_batch(nav_files, args, roots, cache, recorder):
+    """
+    Classify all nav files with a single OpenAI Batch API job: upload one
+    JSONL line per file, poll the batch until it finishes, then map each
+    output line back to its file via custom_id.
+    """
+    results = {}
+    cache_keys = {}
+    lines = []
+    submitted = []
+    files = list(dict.fromkeys(nav_files))
+    for file, content in zip(files, await read_files(files, roots, args.max_chars)):
+        if isinstance(content, Exception):
+            err_msg = f"Error processing file {file}: {content}"
+            print(err_msg)
+            results[file] = err_msg
+            recorder.record(file, err_msg)
+            continue
+        prompt = PROMPT_PREFIX + content + PROMPT_SUFFIX
+        if cache is not None:
+            cache_keys[file] = ResponseCache.key(args.provider, args.model, prompt)
+            cached = cache.get(cache_keys[file])
+            if cached is not None:
+                results[file] = parse_json_response(cached)
+                recorder.record(file, results[file])
+                continue
+        submitted.append(file)
+        lines.append(json.dumps({
+            "custom_id": file,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": openai_chat_params(prompt, args.model),
+        }))
+    if not lines:
+        return {file: results.get(file) for file in nav_files}
+
+    batch_input = await openai_client.files.create(
+        file=("diataxis_batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = await openai_client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"Submitted batch {batch.id} with {len(lines)} request(s).")
+
+    poll_delay = 5
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        print(f"Batch {batch.id} is {batch.status}, checking again in {poll_delay} seconds...")
+        await asyncio.sleep(poll_delay)
+        poll_delay = min(poll_delay * 2, 300)
+        batch = await openai_client.batches.retrieve(batch.id)
+
+    batch_errors = ""
+    if batch.status != "completed":
+        print(f"Batch {batch.id} finished with status '{batch.status}'.")
+        # The reason a batch failed (e.g. input validation) is only reported here.
+        if batch.errors and batch.errors.data:
+            batch_errors = "; ".join(f"{err.code}: {err.message}" for err in batch.errors.data)
+            print(f"Batch errors: {batch_errors}")
+    # Successful requests land in the output file, failed ones in the error file.
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        output = await openai_client.files.content(file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            file = item["custom_id"]
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                message = response["body"]["choices"][0]["message"]
+                raw_response = message.get("content")
+                # content is null when the model refuses.
+                error = f"empty response (refusal: {message.get('refusal')})"
+            else:
+                raw_response = None
+                error = item.get("error") or response.get("body")
+            if raw_response:
+                parsed = parse_json_response(raw_response)
+                if cache is not None and isinstance(parsed, dict) and "error" not in parsed:
+                    cache.set(cache_keys[file], raw_response)
+                print(f"\nResponse for {file}:\n{json.dumps(parsed, indent=4)}")
+                results[file] = parsed
+            else:
+                err_msg = f"Error processing file {file}: {error}"
+                print(err_msg)
+                results[file] = err_msg
+            recorder.record(file, results[file])
+
+    for file in submitted:
+        if file not in results:
+            err_msg = f"Error processing file {file}: no result in batch {batch.id} (status '{batch.status}')"
+            if batch_errors:
+                err_msg += f": {batch_errors}"
+            print(err_msg)
+            results[file] = err_msg
+            recorder.record(file, err_msg)
+    return {file: results.get(file) for file in nav_files}
+
+def classify_nav_files(nav_files, args, roots, script_dir, out):
+    """
+    Classify nav files, skipping those unchanged since the last run, and
+    return their results in nav order.
+    """
+    results = {}
+    pending = nav_files
+    keys = {}
+    manifest_path = os.path.join(script_dir, ".diataxis_manifest.json")
+    manifest = None if args.no_cache else load_manifest(manifest_path)
+    recorder = ResultRecorder(out, manifest, keys)
+    if not args.no_cache:
+        # Skip files whose mtime and size haven't changed since the last run.
+        pending = []
+        for file in nav_files:
+            keys[file] = manifest_key(file, roots, args)
+            entry = manifest.get(file)
+            if keys[file] is not None and entry and entry.get("key") == keys[file]:
+                results[file] = entry["result"]
+                recorder.record(file, results[file])
+            else:
+                pending.append(file)
+        if len(pending) < len(nav_files):
+            print(f"Skipping {len(nav_files) - len(pending)} unchanged file(s).")
+
+    if pending:
+        cache = None if args.no_cache else ResponseCache(os.path.join(script_dir, ".diataxis_cache.sqlite"))
+        try:
+            if args.batch and args.provider == "openai":
+                if args.pack:
+                    print("--pack is not supported with --batch; submitting one request per file.")
+                results.update(asyncio.run(process_files_batch(pending, args, roots, cache, recorder)))
+            else:
+                if args.batch:
+                    print("--batch is only supported with the OpenAI provider; sending individual requests.")
+                results.update(asyncio.run(process_files(pending, args, roots, cache, recorder)))
+        finally:
+            if cache is not None:
+                cache.close()
+            # Save even if interrupted, so results received so far are kept.
+            if manifest is not None:
+                save_manifest(manifest_path, manifest)
+    return {file: results.get(file) for file in nav_files}
+
 def main():
     parser = argparse.ArgumentParser(
         description="Scan MkDocs docs and classify using an API (Diátaxis framework)"
@@ -227,46 +726,44 @@ def main():
     parser.add_argument("--model", "-M", default="gpt-4o", help="Model to use")
     parser.add_argument("--ollama-host", default="http://localhost:11434", help="Host for the Ollama server (default: http://localhost:11434)")
     parser.add_argument("--max-chars", "-l", type=int, default=15000, help="Max number of characters to include from each file's content")
+    parser.add_argument("--concurrency", "-j", type=int, default=None, help="Max number of requests in flight at once (default: 10 for OpenAI, 4 for Ollama)")
+    parser.add_argument("--max-requests-per-minute", type=int, default=500, help="OpenAI requests-per-minute limit to stay under (default: 500)")
+    parser.add_argument("--max-tokens-per-minute", type=int, default=30000, help="OpenAI tokens-per-minute limit to stay under (default: 30000)")
+    parser.add_argument("--pack", action="store_true", help="Classify several files per request instead of one request per file")
+    parser.add_argument("--pack-max-tokens", type=int, default=8000, help="Max combined content tokens per packed request (default: 8000)")
+    parser.add_argument("--batch", action="store_true", help="Submit all files as one OpenAI Batch API job instead of individual requests (OpenAI only)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the on-disk response cache and manifest")
+    parser.add_argument("--out", "-o", help="Write each file's result to this file as a JSON line as soon as it is available, instead of printing aggregated results at the end")
     args = parser.parse_args()
 
     config_path = os.path.abspath(args.config)
+    config = load_config(config_path)
+    # If 'docs_dir' is not specified in the config, default to 'docs'.
+    docs_dir = config.get("docs_dir", "docs")
+    base = os.path.dirname(config_path)
     # Always clone repos into a 'tmp' folder in the same directory as this script.
     script_dir = os.path.dirname(os.path.abspath(__file__))
     clone_dir = os.path.join(script_dir, "tmp")
     print(f"Cloning/updating multi-repo repositories into {clone_dir} ...")
-    clone_multi_repos(config_path, clone_dir)
+    clone_multi_repos(config, clone_dir)
+    roots = (os.path.join(base, docs_dir), base, clone_dir)
     
     try:
-        nav_files = load_mkdocs_nav(config_path)
+        nav_files = load_mkdocs_nav(config)
         if not nav_files:
             print("No files found in the navigation section.")
             return
         print(f"Found {len(nav_files)} file(s) in the navigation.")
 
-        results = {}
-        for file in nav_files:
-            try:
-                content = read_file_content(file, config_path, clone_dir)
-                content = truncate_content(content, args.max_chars)
-                prompt = CUSTOM_PROMPT.format(content=content)
-                print(f"\nProcessing file: {file}")
-                raw_response = send_request(prompt, args.provider, args.model, args.ollama_host)
-                if raw_response:
-                    parsed = parse_json_response(raw_response)
-                    print("Response:")
-                    print(json.dumps(parsed, indent=4))
-                    results[file] = parsed
-                else:
-                    print("No response received for this file.")
-                    results[file] = None
-            except Exception as e:
-                err_msg = f"Error processing file {file}: {e}"
-                print(err_msg)
-                results[file] = err_msg
-            time.sleep(1)
-        
-        print("\nFinal aggregated results:")
-        print(json.dumps(results, indent=4))
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as out:
+                classify_nav_files(nav_files, args, roots, script_dir, out)
+            print(f"\nResults written to {args.out}")
+        else:
+            results = classify_nav_files(nav_files, args, roots, script_dir, None)
+            print("\nFinal aggregated results:")
+            json.dump(results, sys.stdout, indent=4)
+            print()
     except Exception as e:
         print(f"Error: {e}")
 